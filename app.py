@@ -3,15 +3,18 @@ ATH Scanner — Web Server
 Serves the dashboard and provides API endpoints for scan results and status.
 """
 
-import json
-import subprocess
+import os
+import hashlib
+import orjson
 import threading
 import logging
 from datetime import datetime, timezone, timedelta
 from pathlib import Path
-from flask import Flask, jsonify, render_template, send_from_directory
+from flask import Flask, Response, jsonify, render_template, request, send_from_directory
 from apscheduler.schedulers.background import BackgroundScheduler
 
+import scanner
+
 app = Flask(__name__)
 log = logging.getLogger(__name__)
 
@@ -29,6 +32,41 @@ scan_status = {
     "started_at": None,
 }
 
+# Values derived from data files, keyed by path → (mtime_ns, value)
+_file_cache = {}
+
+
+def _cached_load(path: Path, loader):
+    """Return loader(path), reusing the previous value until the file's mtime changes."""
+    mtime = path.stat().st_mtime_ns
+    cached_mtime, value = _file_cache.get(path, (None, None))
+    if cached_mtime != mtime:
+        value = loader(path)
+        _file_cache[path] = (mtime, value)
+    return value
+
+
+def _read_with_etag(path: Path) -> tuple[bytes, str]:
+    buf = path.read_bytes()
+    return buf, hashlib.blake2b(buf, digest_size=16).hexdigest()
+
+
+def _count_symbols(path: Path) -> int:
+    return len(orjson.loads(path.read_bytes()))
+
+
+def _tail(path: Path, n: int = 100, chunk: int = 8192) -> list[str]:
+    """Return the last n lines of a file, reading backwards in fixed-size chunks."""
+    with open(path, 'rb') as f:
+        pos = f.seek(0, os.SEEK_END)
+        buf = b''
+        while pos > 0 and buf.count(b'\n') <= n:
+            step = min(chunk, pos)
+            pos -= step
+            f.seek(pos)
+            buf = f.read(step) + buf
+    return buf.decode('utf-8', errors='replace').splitlines(keepends=True)[-n:]
+
 
 # ── ROUTES ─────────────────────────────────────────────────────────────
 @app.route("/")
@@ -40,8 +78,12 @@ def index():
 def api_results():
     """Return the latest scan results."""
     if DATA_FILE.exists():
-        with open(DATA_FILE) as f:
-            return jsonify(json.load(f))
+        # The file is already JSON — serve its bytes as-is, with an ETag for 304s
+        buf, etag = _cached_load(DATA_FILE, _read_with_etag)
+        resp = Response(buf, mimetype="application/json")
+        resp.set_etag(etag)
+        resp.cache_control.max_age = 5
+        return resp.make_conditional(request)
     return jsonify({
         "scan_date": None,
         "scan_time": None,
@@ -72,9 +114,7 @@ def api_trigger_scan():
 def api_log():
     """Return last 100 lines of scan log."""
     if LOG_FILE.exists():
-        with open(LOG_FILE) as f:
-            lines = f.readlines()
-        return jsonify({"lines": lines[-100:]})
+        return jsonify({"lines": _tail(LOG_FILE, 100)})
     return jsonify({"lines": []})
 
 
@@ -82,15 +122,24 @@ def api_log():
 def api_symbols_count():
     """Return how many symbols are cached."""
     if SYMBOLS_FILE.exists():
-        with open(SYMBOLS_FILE) as f:
-            data = json.load(f)
-        return jsonify({"count": len(data), "cached": True})
+        count = _cached_load(SYMBOLS_FILE, _count_symbols)
+        return jsonify({"count": count, "cached": True})
     return jsonify({"count": 0, "cached": False})
 
 
 # ── BACKGROUND SCAN ────────────────────────────────────────────────────
+def _update_progress(done: int, total: int, found: int):
+    """Progress callback handed to scanner.run_scan()."""
+    scan_status.update({
+        "progress": done,
+        "total": total,
+        "found": found,
+        "message": f"Scanning... {done}/{total} index lists",
+    })
+
+
 def run_scan_background():
-    """Run scanner.py as subprocess and stream progress."""
+    """Run the scanner in-process and track its progress."""
     global scan_status
     scan_status.update({
         "running": True,
@@ -101,45 +150,12 @@ def run_scan_background():
     })
 
     try:
-        import subprocess, sys, re
-        proc = subprocess.Popen(
-            [sys.executable, "scanner.py"],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            text=True,
-            bufsize=1,
-        )
-
-        for line in proc.stdout:
-            line = line.strip()
-            if not line:
-                continue
-
-            # Parse progress
-            m = re.search(r'Progress: (\d+)/(\d+).*ATH found: (\d+)', line)
-            if m:
-                done, total, found = int(m.group(1)), int(m.group(2)), int(m.group(3))
-                scan_status.update({
-                    "progress": done,
-                    "total": total,
-                    "found": found,
-                    "message": f"Scanning... {done}/{total} stocks",
-                })
-
-            # ATH found
-            elif '★ ATH:' in line:
-                scan_status["found"] = scan_status.get("found", 0) + 1
-                scan_status["message"] = line.split('★ ATH:')[-1].strip()
-
-            # Completion
-            elif 'DONE —' in line:
-                scan_status["message"] = line
-
-        proc.wait()
+        payload = scanner.main(progress_cb=_update_progress)
         scan_status.update({
             "running": False,
             "progress": scan_status.get("total", 0),
-            "message": f"Scan complete! Found {scan_status['found']} ATH stocks.",
+            "found": payload["ath_count"],
+            "message": f"Scan complete! Found {payload['ath_count']} ATH stocks.",
         })
         log.info("Background scan finished")
 
@@ -4,25 +4,74 @@ NSE provides free end-of-day data including 52-week highs.
 We use this to identify stocks at or near their all-time highs.
 """
 
-import json
+import os
 import time
+import tempfile
 import logging
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from operator import itemgetter
 from datetime import datetime, timezone, timedelta
 from pathlib import Path
 
-OUTPUT_FILE = Path("data/ath_results.json")
-LOG_FILE    = Path("data/scanner.log")
-IST         = timezone(timedelta(hours=5, minutes=30))
+OUTPUT_FILE  = Path("data/ath_results.json")
+LOG_FILE     = Path("data/scanner.log")
+MISSING_FILE = Path("data/missing_indices.json")
+COOKIE_FILE  = Path("data/nse_cookies.json")
+IST          = timezone(timedelta(hours=5, minutes=30))
+MISSING_TTL  = 86400       # Skip a repeatedly-404ing index for a day, then retry
+MISSING_STRIKES = 3         # Consecutive scans with a 404 before an index is skipped
+COOKIE_TTL   = 30 * 60      # Reuse warmed-up NSE cookies for 30 minutes
 
 Path("data").mkdir(exist_ok=True)
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    handlers=[logging.FileHandler(LOG_FILE), logging.StreamHandler()]
-)
-log = logging.getLogger(__name__)
+LOG_FORMAT = "%(asctime)s [%(levelname)s] %(message)s"
+log = logging.getLogger("scanner")
+
+
+def env_setting(name: str, default, cast, valid):
+    """Read a tunable from the environment; invalid values fall back to default with a warning."""
+    raw = os.getenv(name)
+    if raw is None:
+        return default
+    try:
+        value = cast(raw)
+        if valid(value):
+            return value
+    except ValueError:
+        pass
+    log.warning(f"Ignoring {name}={raw!r}, using default {default}")
+    return default
+
+
+# Tunables — override via environment, e.g. ATH_WORKERS=2 python scanner.py
+# Concurrent index fetches — keep small for NSE
+INDEX_WORKERS  = env_setting("ATH_WORKERS", 4, int, lambda n: n >= 1)
+# lastPrice / yearHigh ratio counted as a high
+HIGH_THRESHOLD = env_setting("ATH_THRESHOLD", 0.98, float, lambda r: 0 < r <= 1)
+
+
+def setup_logging():
+    """
+    Send scanner logs to LOG_FILE and the console. Only the "scanner" logger is
+    configured, so importing this module (e.g. from app.py) leaves the host
+    process's logging alone. Safe to call more than once.
+    """
+    if log.handlers:
+        return
+    file_handler = logging.FileHandler(LOG_FILE)
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    console = logging.StreamHandler()
+    console.setFormatter(logging.Formatter(LOG_FORMAT))
+    log.addHandler(file_handler)
+    log.addHandler(console)
+    log.setLevel(logging.INFO)
+    log.propagate = False
+
 
 NSE_HEADERS = {
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
@@ -68,11 +117,27 @@ NSE_INDICES = [
     "NIFTY SME EMERGE",
 ]
 
+# All F&O securities — fetched alongside the indices to catch non-index stocks
+FNO_LIST = "SECURITIES IN F&O"
 
-def nse_session() -> requests.Session:
-    """Create an NSE session with proper cookies."""
+
+def nse_session(use_cached: bool = True) -> tuple[requests.Session, bool]:
+    """
+    Create an NSE session with proper cookies.
+    Cookies from a warmup within COOKIE_TTL are reused instead of re-hitting
+    the NSE pages; the second value says whether that happened.
+    """
     session = requests.Session()
     session.headers.update(NSE_HEADERS)
+    # Keep-alive pool sized for the index workers, with a short retry on throttling
+    adapter = HTTPAdapter(
+        pool_maxsize=INDEX_WORKERS,
+        max_retries=Retry(total=2, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504]),
+    )
+    session.mount("https://", adapter)
+    if use_cached and load_cookies(session):
+        log.info("Reusing cached NSE cookies")
+        return session, True
     try:
         # Must hit the main page first to get cookies
         session.get("https://www.nseindia.com", timeout=15)
@@ -81,19 +146,105 @@ def nse_session() -> requests.Session:
         time.sleep(0.5)
     except Exception as e:
         log.warning(f"NSE session setup: {e}")
-    return session
+    return session, False
 
 
-def fetch_index_stocks(session: requests.Session, index_name: str) -> list[dict]:
-    """Fetch all stocks in an NSE index with their 52-week high data."""
+def load_cookies(session: requests.Session) -> bool:
+    """Load cookies saved within COOKIE_TTL into the session; False if none are usable."""
+    if not COOKIE_FILE.exists() or time.time() - COOKIE_FILE.stat().st_mtime > COOKIE_TTL:
+        return False
+    try:
+        session.cookies.update(orjson.loads(COOKIE_FILE.read_bytes()))
+    except Exception as e:
+        log.warning(f"NSE cookie cache unreadable: {e}")
+        return False
+    return True
+
+
+def save_cookies(session: requests.Session):
+    """Cache the session's cookies for load_cookies(); failures only cost the next warmup."""
+    try:
+        write_atomic(COOKIE_FILE, orjson.dumps(requests.utils.dict_from_cookiejar(session.cookies)))
+    except Exception as e:
+        log.warning(f"NSE cookie cache not saved: {e}")
+
+
+def write_atomic(path: Path, data: bytes):
+    """
+    Write via a temp file + os.replace so readers never see a half-written file.
+    The temp name is unique per call, so concurrent scans can't trip each other.
+    """
+    tmp = tempfile.NamedTemporaryFile(dir=path.parent, prefix=f"{path.name}.", suffix='.tmp', delete=False)
+    try:
+        with tmp as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp.name, 0o644)  # NamedTemporaryFile creates 0600
+        os.replace(tmp.name, path)
+    except BaseException:
+        Path(tmp.name).unlink(missing_ok=True)
+        raise
+
+
+def load_missing_indices() -> dict[str, dict]:
+    """
+    Load the 404 record: index name → {"strikes": consecutive scans it 404'd in,
+    "last": time of the latest 404}. Malformed entries are dropped.
+    """
+    if not MISSING_FILE.exists():
+        return {}
+    try:
+        data = orjson.loads(MISSING_FILE.read_bytes())
+    except Exception as e:
+        log.warning(f"Missing-index record unreadable: {e}")
+        return {}
+    if not isinstance(data, dict):
+        return {}
+    record = {}
+    for name, entry in data.items():
+        try:
+            record[name] = {"strikes": int(entry["strikes"]), "last": float(entry["last"])}
+        except (TypeError, KeyError, ValueError):
+            continue
+    return record
+
+
+def update_missing_indices(record: dict[str, dict], lists: list[str], not_found: set[str]):
+    """Count one strike per scan for lists that 404'd; any other outcome clears the record."""
+    now = time.time()
+    for name in lists:
+        if name in not_found:
+            strikes = record.get(name, {}).get("strikes", 0) + 1
+            record[name] = {"strikes": strikes, "last": now}
+        else:
+            record.pop(name, None)
+    try:
+        write_atomic(MISSING_FILE, orjson.dumps(record))
+    except Exception as e:
+        log.warning(f"Missing-index record not saved: {e}")
+
+
+def fetch_index_stocks(session: requests.Session, index_name: str,
+                       not_found: set[str] | None = None,
+                       rejected: set[str] | None = None) -> list[dict]:
+    """
+    Fetch all stocks in an NSE index with their 52-week high data.
+    A 404 is recorded in `not_found` (see update_missing_indices());
+    a 401/403 (cookies expired or refused) is recorded in `rejected`.
+    """
     try:
         url = f"https://www.nseindia.com/api/equity-stockIndices?index={requests.utils.quote(index_name)}"
         resp = session.get(url, timeout=20)
+        if resp.status_code == 404 and not_found is not None:
+            not_found.add(index_name)
+        if resp.status_code in (401, 403) and rejected is not None:
+            rejected.add(index_name)
         if resp.status_code != 200:
             log.warning(f"Index {index_name}: HTTP {resp.status_code}")
             return []
 
-        data = resp.json()
+        data = orjson.loads(resp.content)
         stocks = data.get('data', [])
         log.info(f"Index '{index_name}': {len(stocks)} stocks")
         return stocks
@@ -102,82 +253,117 @@ def fetch_index_stocks(session: requests.Session, index_name: str) -> list[dict]
         return []
 
 
-def is_at_52w_high(stock: dict) -> bool:
+def check_52w_high(stock: dict) -> tuple[float, float] | None:
     """
     Check if stock is at or near its 52-week high.
     NSE provides: lastPrice, yearHigh (52-week high)
-    If lastPrice >= yearHigh * 0.98, it's at/near 52-week high.
+    If lastPrice >= yearHigh * HIGH_THRESHOLD (0.98 by default), it's at/near
+    52-week high and (last, high) is returned already parsed; otherwise None.
     """
+    last = stock.get('lastPrice')
+    high = stock.get('yearHigh')
+    if not last or not high:
+        return None
     try:
-        last  = float(stock.get('lastPrice', 0))
-        high  = float(stock.get('yearHigh', 0))
-        if last <= 0 or high <= 0:
-            return False
-        return last >= high * 0.98
-    except:
-        return False
+        last, high = float(last), float(high)
+    except (TypeError, ValueError):
+        return None
+    if last <= 0 or high <= 0 or last < high * HIGH_THRESHOLD:
+        return None
+    return last, high
+
+
+def to_result(stock: dict, last: float, high: float) -> dict:
+    """Build the saved result row for a stock that passed check_52w_high()."""
+    sym  = stock.get('symbol', '')
+    name = stock.get('meta', {}).get('companyName', '') or sym
+    chg  = float(stock.get('pChange') or 0)
+    log.info(f"★ 52W HIGH: {sym} — {name} @ ₹{last}")
+    return {
+        'symbol':   f"{sym}.NS",
+        'name':     name,
+        'price':    round(last, 2),
+        'ath':      round(high, 2),
+        'change':   round(chg, 2),
+        'exchange': 'NSE',
+        'series':   'EQ',
+    }
+
 
+def scan_lists(session: requests.Session, lists: list[str], not_found: set[str],
+               rejected: set[str], seen: set[str], ath_stocks: list[dict], on_list):
+    """
+    Fetch index lists concurrently over the shared session and check each new
+    symbol as its list arrives, adding to `seen` and `ath_stocks` in place.
+    map() keeps list order so dedup still prefers the earliest index listing a
+    symbol. on_list(found) is called after each list; lists NSE answered
+    401/403 for end up in `rejected`.
+    """
+    fetch = partial(fetch_index_stocks, session, not_found=not_found, rejected=rejected)
+    with ThreadPoolExecutor(max_workers=INDEX_WORKERS) as pool:
+        for stocks in pool.map(fetch, lists):
+            for s in stocks:
+                sym = s.get('symbol', '')
+                if not sym or sym in seen or sym == '-':
+                    continue
+                seen.add(sym)
+                prices = check_52w_high(s)
+                if prices:
+                    ath_stocks.append(to_result(s, *prices))
+            on_list(len(ath_stocks))
 
-def run_scan() -> list[dict]:
+
+def run_scan(progress_cb=None) -> tuple[list[dict], int]:
     """
     Scan all NSE indices for stocks at 52-week highs.
     52-week high is the best proxy for ATH available from free APIs.
+    progress_cb, if given, is called as progress_cb(done, total, found)
+    with done/total counting index lists fetched (FNO_LIST included).
     """
     log.info("Starting NSE scan...")
-    session   = nse_session()
-    seen      = set()
-    ath_stocks = []
-    all_stocks = []
-
-    # Fetch all stocks across all indices
-    for index_name in NSE_INDICES:
-        stocks = fetch_index_stocks(session, index_name)
-        for s in stocks:
-            sym = s.get('symbol', '')
-            if sym and sym not in seen and sym != '-':
-                seen.add(sym)
-                all_stocks.append(s)
-        time.sleep(0.3)  # Be polite to NSE API
+    session, cached = nse_session()
 
-    log.info(f"Total unique stocks fetched: {len(all_stocks)}")
+    # Skip indices NSE has answered 404 for in several scans running, for a day
+    missing = load_missing_indices()
+    now     = time.time()
+    skipped = [name for name, entry in missing.items()
+               if entry["strikes"] >= MISSING_STRIKES and now - entry["last"] < MISSING_TTL]
+    lists   = [name for name in NSE_INDICES + [FNO_LIST] if name not in skipped]
+    if skipped:
+        log.warning(f"Skipping indices NSE answered 404 for in {MISSING_STRIKES}+ scans: {', '.join(skipped)}")
 
-    # Also fetch all securities list
-    try:
-        url = "https://www.nseindia.com/api/equity-stockIndices?index=SECURITIES%20IN%20F%26O"
-        resp = session.get(url, timeout=20)
-        if resp.status_code == 200:
-            for s in resp.json().get('data', []):
-                sym = s.get('symbol', '')
-                if sym and sym not in seen:
-                    seen.add(sym)
-                    all_stocks.append(s)
-    except Exception as e:
-        log.warning(f"F&O list error: {e}")
-
-    log.info(f"Total stocks to check: {len(all_stocks)}")
-
-    # Check each for 52-week high
-    for s in all_stocks:
-        if is_at_52w_high(s):
-            sym  = s.get('symbol', '')
-            name = s.get('meta', {}).get('companyName', '') or sym
-            last = float(s.get('lastPrice', 0))
-            high = float(s.get('yearHigh', 0))
-            chg  = float(s.get('pChange', 0))
-
-            ath_stocks.append({
-                'symbol':   f"{sym}.NS",
-                'name':     name,
-                'price':    round(last, 2),
-                'ath':      round(high, 2),
-                'change':   round(chg, 2),
-                'exchange': 'NSE',
-                'series':   'EQ',
-            })
-            log.info(f"★ 52W HIGH: {sym} — {name} @ ₹{last}")
+    report   = progress_cb or (lambda done, total, found: None)
+    progress = {"done": 0}
+
+    def on_list(found: int):
+        progress["done"] += 1
+        report(progress["done"], len(lists), found)
+
+    seen       = set()
+    ath_stocks = []
+    rejected   = set()
+    not_found  = set()
+    scan_lists(session, lists, not_found, rejected, seen, ath_stocks, on_list)
+
+    # NSE refused our cookies (expired cache or mid-scan expiry) — warm up a
+    # fresh session once and re-fetch just the refused lists
+    if rejected:
+        log.warning(f"NSE rejected session for {len(rejected)} lists, re-warming")
+        COOKIE_FILE.unlink(missing_ok=True)
+        session, cached = nse_session(use_cached=False)
+        retry = [name for name in lists if name in rejected]
+        rejected.clear()
+        progress["done"] -= len(retry)
+        scan_lists(session, retry, not_found, rejected, seen, ath_stocks, on_list)
+        if rejected:
+            log.warning(f"Still rejected after re-warm: {', '.join(sorted(rejected))}")
+    if seen and not cached:
+        save_cookies(session)
+    update_missing_indices(missing, lists, not_found)
 
+    log.info(f"Total stocks checked: {len(seen)}")
     log.info(f"Stocks at 52-week high: {len(ath_stocks)}")
-    return ath_stocks, len(all_stocks)
+    return ath_stocks, len(seen)
 
 
 def save_results(ath_stocks: list, total_scanned: int):
@@ -189,22 +375,24 @@ def save_results(ath_stocks: list, total_scanned: int):
         "total_scanned": total_scanned,
         "ath_count":     len(ath_stocks),
         "label":         "52-Week High",
-        "stocks":        sorted(ath_stocks, key=lambda x: x['symbol']),
+        "stocks":        sorted(ath_stocks, key=itemgetter('symbol')),
     }
-    with open(OUTPUT_FILE, 'w') as f:
-        json.dump(payload, f, indent=2)
+    write_atomic(OUTPUT_FILE, orjson.dumps(payload))  # Compact — only read by /api/results
     log.info(f"Saved {len(ath_stocks)} results → {OUTPUT_FILE}")
     return payload
 
 
-def main():
+def main(progress_cb=None):
+    """Run a full scan and save it; returns the saved payload."""
+    setup_logging()
     log.info("=" * 60)
     log.info("ATH SCANNER STARTED (NSE Official API)")
     log.info("=" * 60)
     try:
-        ath_stocks, total = run_scan()
-        save_results(ath_stocks, total)
+        ath_stocks, total = run_scan(progress_cb)
+        payload = save_results(ath_stocks, total)
         log.info(f"DONE — {len(ath_stocks)} stocks at 52-week high from {total} scanned")
+        return payload
     except Exception as e:
         log.error(f"Scan failed: {e}")
         raise